@@ -1,368 +1,1165 @@
 import os
 import sys
-import json
+import re
+import io
+import base64
+import binascii
 import hashlib
-from flask import Flask, request, jsonify, send_from_directory
+import threading
+import queue
+import atexit
+import logging
+import logging.handlers
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from typing import Annotated, Literal, Optional
+from cachetools import TTLCache
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from openai import OpenAI
+from flask_compress import Compress
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from pydantic import BaseModel, BeforeValidator, Json, PositiveInt, ValidationError
+from openai import OpenAI, DefaultHttpxClient
+import httpx
+import orjson
+from PIL import Image, ImageOps
 import requests
 
-# Simple in-memory cache for analysis results
-analysis_cache = {}
+# Logging is handed to a background thread through a queue so request threads
+# never block on writing to stderr
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
-# Simple in-memory cache for OCR results
-ocr_cache = {}
+logger = logging.getLogger('principia')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+
+# Bounded in-memory caches; entries expire after an hour
+CACHE_MAX_ENTRIES = 10_000
+CACHE_TTL_SECONDS = 3600
+
+# Cache for analysis results
+analysis_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+
+# Cache for format conversion results
+convert_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+
+# Cache for OCR results
+ocr_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+
+# TTLCache is not thread-safe and requests are served on multiple threads
+cache_lock = threading.Lock()
+
+def cache_get(cache, key):
+    with cache_lock:
+        return cache.get(key)
+
+def cache_set(cache, key, value):
+    with cache_lock:
+        cache[key] = value
+
+# Analyses currently being generated, keyed like analysis_cache, so that
+# concurrent identical requests wait for one LLM call instead of starting their own
+inflight_analyses = {}
+inflight_lock = threading.Lock()
+# Longer than the leader's worst case (75 s fused call + 45 s fallback visualization call)
+INFLIGHT_WAIT_SECONDS = 150
+
+class AnalysisCancelled(Exception):
+    pass
+
+def join_inflight(key):
+    """Return (future, is_leader); only the leader should run the LLM calls."""
+    with inflight_lock:
+        future = inflight_analyses.get(key)
+        if future is not None:
+            return future, False
+        future = Future()
+        inflight_analyses[key] = future
+        return future, True
+
+def leave_inflight(key, future):
+    with inflight_lock:
+        inflight_analyses.pop(key, None)
+    # The leader's client disconnected mid-stream; wake anyone waiting on it so
+    # one of them can take over the generation
+    if not future.done():
+        future.set_exception(AnalysisCancelled())
 
 # Cache key generation function
-def generate_cache_key(context, full_context):
-    combined = f"{context}:{full_context}"
-    return hashlib.md5(combined.encode()).hexdigest()
+def generate_cache_key(*parts):
+    combined = '\x1f'.join(str(part) for part in parts)
+    return hashlib.sha256(combined.encode()).hexdigest()
+
+# Collapse whitespace so re-selections of the same formula share a cache entry
+def normalize_whitespace(text):
+    return ' '.join(text.split())
+
+# Document context sent to the LLM: the region around the target formula plus
+# the document opening, instead of the whole (possibly very long) document
+CONTEXT_RADIUS = 2000
+CONTEXT_HEAD_LENGTH = 500
+
+def window_context(full_context, target, radius=CONTEXT_RADIUS):
+    if len(full_context) <= 2 * radius + len(target) + CONTEXT_HEAD_LENGTH:
+        return full_context
+    index = full_context.find(target)
+    if index < 0:
+        return full_context[:2 * radius + len(target)] + '\n...'
+    start = max(0, index - radius)
+    end = index + len(target) + radius
+    window = full_context[start:end]
+    if start > CONTEXT_HEAD_LENGTH:
+        # Keep the title/introduction so the topic and language stay visible
+        window = full_context[:CONTEXT_HEAD_LENGTH] + '\n...\n' + window
+    elif start > 0:
+        window = full_context[:start] + window
+    if end < len(full_context):
+        window += '\n...'
+    return window
 
 # OCR cache key generation function
-def generate_ocr_cache_key(image_data, previous_context, next_context):
-    combined = f"{image_data}:{previous_context}:{next_context}"
-    return hashlib.md5(combined.encode()).hexdigest()
+def generate_ocr_cache_key(image_bytes, previous_context, next_context):
+    digest = hashlib.md5(image_bytes)
+    digest.update(f":{previous_context}:{next_context}".encode())
+    return digest.hexdigest()
+
+# Split a base64 data URL into its MIME type and raw bytes; None if it isn't one
+def decode_image_data_url(image_data):
+    header, separator, payload = image_data.partition(',')
+    if not separator or not header.startswith('data:image/') or not header.endswith(';base64'):
+        return None
+    try:
+        return header[len('data:'):-len(';base64')], base64.b64decode(payload)
+    except (binascii.Error, ValueError):
+        return None
+
+# Handwriting OCR does not need more resolution than this; larger uploads are
+# downscaled and re-encoded as JPEG before being sent to the vision model
+OCR_MAX_IMAGE_SIDE = 1600
+OCR_JPEG_QUALITY = 85
+
+# Pillow reports many phone JPEGs as MPO; vision APIs only accept them as JPEG
+PILLOW_FORMAT_MIME = {'MPO': 'image/jpeg'}
+
+def shrink_image(image_bytes, mime_type):
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+    except (OSError, ValueError):
+        return mime_type, image_bytes
+    if not mime_type.startswith('image/'):
+        # Untyped upload (e.g. application/octet-stream): use the format Pillow detected
+        mime_type = PILLOW_FORMAT_MIME.get(image.format) or Image.MIME.get(image.format, mime_type)
+
+    # Re-encoding drops EXIF, so apply the orientation tag (portrait phone photos) first
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((OCR_MAX_IMAGE_SIDE, OCR_MAX_IMAGE_SIDE), Image.LANCZOS)
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        # JPEG has no alpha channel; flatten onto white so transparent areas don't turn black
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    else:
+        image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=OCR_JPEG_QUALITY, optimize=True)
+    if buffer.tell() >= len(image_bytes):
+        return mime_type, image_bytes
+    return 'image/jpeg', buffer.getvalue()
 
 # Configuration
 PORT = 8000
+# Request body cap, matching client_max_body_size in nginx.conf, for deployments without nginx
+MAX_REQUEST_BYTES = 25 * 1024 * 1024
+SERVE_STATIC = os.environ.get('PRINCIPIA_SERVE_STATIC', '1') != '0'
+# Rate limits are counted in-process by default; point this at Redis
+# (e.g. redis://localhost:6379) so every gunicorn worker shares one count.
+RATE_LIMIT_STORAGE_URI = os.environ.get('PRINCIPIA_RATE_LIMIT_STORAGE', 'memory://')
+LLM_RATE_LIMIT = os.environ.get('PRINCIPIA_RATE_LIMIT', '30/minute;500/hour')
+
+# Shared connection pool for all outbound LLM calls. The endpoints are
+# synchronous and LLM requests spend nearly all their time waiting on the
+# network, so concurrency comes from serving each request on its own thread;
+# a single thread-safe pool lets those threads share keep-alive connections.
+http_client = DefaultHttpxClient(
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200)
+)
+
+# Reuse client instances per (api_key, base_url) instead of building new ones per request
+@lru_cache(maxsize=64)
+def get_client(api_key, base_url):
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+# Server-Sent Events helpers for streaming LLM output to the browser
+def sse_event(event_type, **payload):
+    return b'data: ' + orjson.dumps({'type': event_type, **payload}) + b'\n\n'
+
+# SSE comment frame; clients ignore it, but it keeps idle connections (and proxy
+# read timeouts) from expiring while a request waits on another one's analysis
+SSE_KEEPALIVE = b': keepalive\n\n'
+SSE_KEEPALIVE_SECONDS = 15
+
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+        }
+    )
+
+# Markdown code fence wrapping a whole LLM response, e.g. ```html ... ```.
+# Either fence may be missing (the closing one is lost when output is truncated).
+CODE_FENCE_RE = re.compile(r'^\s*(?:```[\w-]*[ \t]*\n?)?(.*?)(?:\n?```)?\s*$', re.DOTALL)
+
+def strip_code_fence(text):
+    return CODE_FENCE_RE.match(text).group(1).strip()
+
+# Yield the text deltas of a streamed chat completion
+def stream_completion(client, **kwargs):
+    # Closing the generator early also closes the HTTP response
+    with client.chat.completions.create(stream=True, **kwargs) as stream:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+# Prompt templates. Built once at import; requests only substitute the dynamic fields.
+EXPLANATION_SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful physics tutor."}
+VISUALIZATION_SYSTEM_MESSAGE = {"role": "system", "content": "You are a code generator. Output raw HTML/JS only."}
+CONVERT_SYSTEM_MESSAGE = {"role": "system", "content": "You are a document format converter."}
+
+EXPLANATION_PROMPT = """\
+You are an expert physics and mathematics tutor.
+
+Target Formula/Concept: "{context}"
+
+Full Document Context:
+"{full_context}"
+
+Task:
+1. Analyze the "Target Formula/Concept" within the context of the "Full Document Context".
+2. Provide a brief, clear, and insightful explanation. Focus on the "why" and "how".
+3. **LANGUAGE DETECTION**: Detect the language used in the "Full Document Context" (e.g., English, Chinese, French).
+4. **OUTPUT LANGUAGE**: Your explanation MUST be in the SAME language as the "Full Document Context". If the context is mixed, prioritize the language of the descriptive text surrounding the formula.
+5. **MATH RENDERING**: If your explanation includes mathematical formulas, YOU MUST wrap them in standard LaTeX math delimiters:
+   - Use $...$ for inline math (e.g., $E=mc^2$).
+   - Use $$...$$ for display math.
+   - DO NOT use markdown code blocks for math.
+6. Return ONLY the explanation text.
+"""
+
+VISUALIZATION_PROMPT = """\
+You are an expert frontend developer and physics simulation specialist.
+
+Task: Create a **Dynamic, Interactive Physics Simulation** using HTML5 Canvas and JavaScript.
+
+**Source Material**:
+1. **Target Concept**: "{context}"
+2. **Physics Logic (Source of Truth for Formulas)**:
+   "{explanation}"
+3. **Scenario Context (Source of Truth for Environment/Parameters)**:
+   "{full_context}"
+
+**Implementation Strategy**:
+1. **Analyze the Physics**: Use the "Physics Logic" to determine the governing equations (kinematics, dynamics, wave equations, etc.).
+2. **Extract Parameters**: Scan the "Scenario Context" for specific values (e.g., "velocity of 20m/s", "angle of 45 degrees", "mass of 5kg").
+   - **CRITICAL**: If the context mentions specific numbers, YOU MUST set them as the initial values for your simulation variables.
+3. **Design the Visuals**: Use the "Scenario Context" to decide what to draw (e.g., if it mentions a "cliff", draw a cliff; if "spring", draw a spring).
+
+CRITICAL REQUIREMENTS:
+1. **Relevance**: The simulation MUST directly visualize the specific physics concept described.
+   - Use the context to understand specific scenarios.
+   - If it's a projectile, show a projectile.
+   - If it's a wave, show a wave.
+   - If it's a field, show vector fields or particles in a field.
+   - If it's a function, create a function graphing tool.
+   - **DO NOT default to a pendulum or spring unless the concept specifically calls for it.**
+
+2. **Physics Accuracy**: Use `requestAnimationFrame` to animate the system based on real physics equations derived from the concept.
+
+3. **Interactivity**:
+   - Include HTML range sliders to adjust key parameters relevant to the specific model (e.g., initial velocity, charge, frequency, mass).
+   - For function graphs, include input fields for function equations and parameter adjustments.
+   - Provide play/pause/reset controls for simulations.
+
+4. **Style**:
+  - Background: Dark (`#000` or `#111`).
+  - Text: Light (`#eee`).
+  - Controls: Minimalist, styled for dark mode, with clear labels.
+
+5. **Advanced Features**:
+   - For function graphs: Support multiple functions on the same graph with different colors.
+   - For simulations: Include real-time data display (e.g., position, velocity, energy).
+   - Add zoom and pan functionality for better exploration.
+
+6. **Language Adaptation**:
+  - **LANGUAGE DETECTION**: Detect the language used in the "Full Document Context" (e.g., English, Chinese, French).
+  - **OUTPUT LANGUAGE**: Any text displayed in the simulation (labels, titles, slider names, instructions) MUST be in the SAME language as the "Full Document Context". If the context is mixed, prioritize the language of the descriptive text surrounding the formula.
+
+7. **Output Format**:
+  - Return **ONLY** the HTML snippet containing the container `div`, controls, and the `script` tag.
+  - Do NOT include `<html>`, `<head>`, `<body>`, or markdown code fences.
+  - The root container must have `width: 100%; height: 300px;`.
+"""
+
+# Used when explanation and visualization go to the same model: one call produces
+# both parts, divided by ANALYSIS_SEPARATOR, so they can still be streamed separately
+ANALYSIS_SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful physics tutor and a code generator. Write the explanation as text and the simulation as raw HTML/JS only."}
+ANALYSIS_SEPARATOR = "=====VISUALIZATION====="
+
+FUSED_ANALYSIS_PROMPT = """\
+Complete two tasks in a single response, in this order. Each "Return ONLY" rule below applies to its own part.
+
+PART 1 - EXPLANATION
+{explanation_task}
+After the explanation, output a line containing exactly:
+{separator}
+
+PART 2 - VISUALIZATION
+{visualization_task}"""
+
+CONVERT_TO_LATEX_PROMPT = r"""
+Convert the following Markdown/LaTeX mixed content into a pure, compile-ready LaTeX document body.
+
+Rules:
+1. Convert Markdown headers (#, ##) to LaTeX sections (\section, \subsection).
+2. Convert Markdown lists (- , 1.) to LaTeX lists (itemize, enumerate).
+3. Convert Markdown bold/italic to LaTeX (\textbf, \textit).
+4. **COLOR PRESERVATION**:
+   - Keep `\textcolor{{color}}{{text}}` as is.
+   - Convert `<font color="color">text</font>` to `\textcolor{{color}}{{text}}` (if present).
+   - Convert `<span style="color: color">text</span>` to `\textcolor{{color}}{{text}}` (if present).
+5. Keep existing LaTeX math ($...$, $$...$$) unchanged.
+6. Return ONLY the converted LaTeX body code. Do NOT wrap in \documentclass.
+7. Do not include markdown code fences.
+
+Content:
+"{content}"
+"""
+
+CONVERT_TO_MARKDOWN_PROMPT = r"""
+Convert the following LaTeX content into clean Markdown.
+
+Rules:
+1. **COLOR PRESERVATION (HIGHEST PRIORITY)**:
+   - **KEEP** `\textcolor{{color}}{{text}}` commands AS IS.
+   - **DO NOT** convert color to bold (`**`) or italic (`*`).
+   - **DO NOT** convert color to HTML.
+   - Convert `{{\color{{color}} text}}` to `\textcolor{{color}}{{text}}`.
+2. Convert LaTeX sections (\section, \subsection) to Markdown headers (#, ##).
+3. Convert LaTeX lists to Markdown lists.
+4. Convert LaTeX text formatting (\textbf, \textit) to Markdown (**...**, *...*).
+   - Only convert `\textbf` and `\textit`. DO NOT touch `\textcolor`.
+5. Keep LaTeX math ($...$, $$...$$) unchanged.
+6. Return ONLY the converted Markdown content.
+7. Do not include markdown code fences.
+
+Content:
+"{content}"
+"""
+
+# Raw string: the rules are full of LaTeX commands (\frac, \begin, \textcolor, ...)
+OCR_PROMPT = r"""Transcribe this handwritten note into valid XeLaTeX code with high accuracy.
+
+DETAILED RECOGNITION RULES:
+1. **Content Extraction**: Capture ALL visible content, including handwritten text, printed text, mathematical formulas, symbols, diagrams, and annotations.
+2. **LaTeX Formatting**: 
+   - Return ONLY the body content (formulas, text, etc.).
+   - Do NOT include \documentclass, \begin{document}, \maketitle, or \end{document}.
+   - Assume standard packages (amsmath, amssymb, geometry, xcolor) are already loaded.
+3. **Mathematical Formula Recognition**: 
+   - Use standard LaTeX math mode ($...$ for inline, $$...$$ for display).
+   - For complex formulas, use appropriate LaTeX environments (e.g., align, equation, cases).
+   - Correctly identify and format mathematical symbols, operators, and functions.
+   - Recognize subscripts and superscripts accurately (e.g., x_1, x^2, x_1^2).
+   - For fractions, use \frac{numerator}{denominator} or \dfrac for display-style fractions.
+   - For integrals, use proper LaTeX syntax (e.g., \int, \iint, \oint) with correct limits.
+   - For vectors and matrices, use appropriate notation (e.g., \vec{v}, \mathbf{M}, \begin{matrix}).
+   - For derivatives, use \frac{d}{dx} or \frac{\partial}{\partial x} as appropriate.
+4. **Contextual Correction**: Correct any obvious physical or mathematical errors based on context, but preserve the original intent of the writing.
+5. **Output Format**: Return ONLY the LaTeX code, no markdown fencing.
+6. **COLOR DETECTION (ENHANCED)**: 
+   - **Color Identification**: Carefully analyze the color of each handwritten stroke, considering both hue and intensity.
+   - **Color Categories**: Recognize the following colors with high accuracy:
+     * Red (\textcolor{red}{...})
+     * Blue (\textcolor{blue}{...})
+     * Green (\textcolor{green}{...})
+     * Orange (\textcolor{orange}{...})
+     * Purple (\textcolor{purple}{...})
+     * Black (no color command)
+     * Gray (no color command)
+     * White (no color command)
+   - **Color Consistency**: Apply color commands consistently to entire words, phrases, or formulas written in the same color.
+   - **Mixed Colors**: If different parts of the same formula or text are in different colors, apply color commands to each part separately.
+   - **Background Consideration**: Consider the background color when determining the text color (e.g., light text on dark background).
+7. **Layout Preservation**: Maintain the original layout and structure of the content, including line breaks, indentation, and spacing.
+8. **Symbol Recognition**: Accurately identify and transcribe special symbols, Greek letters, and mathematical notation.
+9. **Handwriting Variations**: Account for different handwriting styles and variations in character formation.
+10. **Context Integration**: Use the provided previous and next context to ensure accurate transcription and proper formatting.
+"""
+
+OCR_PREVIOUS_CONTEXT = (
+    "\n\nPREVIOUS CONTEXT (The text immediately preceding this image):\n...",
+    "\n\nINSTRUCTION: Ensure your transcription flows naturally from this previous context."
+)
+
+OCR_NEXT_CONTEXT = (
+    "\n\nNEXT CONTEXT (The text immediately following this image):\n",
+    "...\n\nINSTRUCTION: Ensure your transcription connects smoothly to this next context."
+)
+
+# Serialize request and response bodies with orjson instead of the stdlib json module
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    # jsonify() goes through here; hand orjson's bytes straight to the response
+    # instead of decoding them to str only for the response to re-encode them
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+# Request payloads, validated once per request straight from the raw body.
+# An explicit null is treated like an omitted field, as clients have always sent it.
+def null_as(default):
+    return BeforeValidator(lambda value: default if value is None else value)
+
+Text = Annotated[str, null_as('')]
+
+class LLMConfig(BaseModel):
+    apiKey: Text = ''
+    baseUrl: Optional[str] = None
+    model: Text = ''
+    maxTokens: Optional[PositiveInt] = None
+
+class AnalyzeRequest(BaseModel):
+    context: Text = ''
+    fullContext: Text = ''
+    reasoningConfig: Optional[LLMConfig] = None
+    visionConfig: Optional[LLMConfig] = None
+
+class ConvertRequest(BaseModel):
+    content: Text = ''
+    targetFormat: Annotated[Literal['tex', 'md'], null_as('tex')] = 'tex'
+    reasoningConfig: Optional[LLMConfig] = None
+
+class OCRRequest(BaseModel):
+    image: Text = ''
+    visionConfig: Optional[LLMConfig] = None
+    previousContext: Text = ''
+    nextContext: Text = ''
+
+# Multipart OCR upload: the image arrives as a file part, the config as a JSON string
+class OCRUploadFields(BaseModel):
+    visionConfig: Optional[Json[LLMConfig]] = None
+    previousContext: str = ''
+    nextContext: str = ''
+
+def validation_error_response(error):
+    details = '; '.join(
+        f"{'.'.join(str(part) for part in err['loc']) or 'body'}: {err['msg']}" for err in error.errors()
+    )
+    return jsonify({'error': f'Invalid request: {details}'}), 400
+
+# Generation limits. Output length dominates LLM latency, so each call is capped;
+# clients can raise a cap with "maxTokens" in reasoningConfig (explanation) or
+# visionConfig (visualization and OCR) if they see truncated output.
+EXPLANATION_MAX_TOKENS = 600
+VISUALIZATION_MAX_TOKENS = 4096
+OCR_MAX_TOKENS = 1500
+
+# Stop at a closing code fence on its own line; the simulation is complete by then
+VISUALIZATION_STOP = ['\n```\n']
+
+def max_tokens(config, default):
+    return config.maxTokens or default
+
+# Index where the visualization's closing code fence starts, or -1 if it hasn't arrived yet
+def closing_fence_index(text, fence_end=VISUALIZATION_STOP[0]):
+    opening = text.find('```')
+    body = text.find('\n', opening) if opening >= 0 else -1
+    return text.find(fence_end, body) if body >= 0 else -1
+
+# Split a fused analysis stream into ('explanation' | 'visualization', text) pieces.
+# The tail of the buffer is held back until it can no longer be the start of the separator.
+# The fused call can't use VISUALIZATION_STOP (a code block in the explanation would end
+# it before the separator), so the stream is closed at the visualization's closing fence here.
+def split_analysis_stream(deltas, separator=ANALYSIS_SEPARATOR):
+    buffer = ''
+    visualization = None
+    emitted = 0
+    hold = len(VISUALIZATION_STOP[0]) - 1
+    for delta in deltas:
+        if visualization is None:
+            buffer += delta
+            index = buffer.find(separator)
+            if index < 0:
+                if len(buffer) >= len(separator):
+                    yield 'explanation', buffer[:1 - len(separator)]
+                    buffer = buffer[1 - len(separator):]
+                continue
+            if buffer[:index]:
+                yield 'explanation', buffer[:index]
+            visualization, buffer = buffer[index + len(separator):], ''
+        else:
+            visualization += delta
+        end = closing_fence_index(visualization)
+        if end >= 0:
+            if end > emitted:
+                yield 'visualization', visualization[emitted:end]
+            deltas.close()
+            return
+        if len(visualization) - hold > emitted:
+            yield 'visualization', visualization[emitted:len(visualization) - hold]
+            emitted = len(visualization) - hold
+    if visualization is None:
+        if buffer:
+            yield 'explanation', buffer
+    elif len(visualization) > emitted:
+        yield 'visualization', visualization[emitted:]
 
 # Initialize Flask App
 app = Flask(__name__, static_folder='principia/dist')
+app.json = OrjsonProvider(app)
 CORS(app)  # Enable CORS for all routes
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+# Compress JSON responses (visualization HTML and LaTeX compress several times over).
+# Streamed responses are left alone: compressing them here would buffer SSE frames,
+# so nginx compresses those per chunk instead (see nginx.conf).
+app.config.update(
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_LEVEL=5,
+    COMPRESS_BR_LEVEL=5,
+    COMPRESS_MIN_SIZE=500,
+    COMPRESS_STREAMS=False
+)
+Compress(app)
+
+# Validate each API request body once, before the rate limiter and the view both need it.
+# Registered ahead of the limiter so its key function can read g.payload.
+REQUEST_MODELS = {
+    'analyze': AnalyzeRequest,
+    'convert_format': ConvertRequest,
+    'ocr': OCRRequest
+}
+
+@app.before_request
+def parse_payload():
+    model = REQUEST_MODELS.get(request.endpoint)
+    if model is None or request.method != 'POST':
+        return None
+    try:
+        if model is OCRRequest and request.mimetype == 'multipart/form-data':
+            g.payload = OCRUploadFields.model_validate(request.form.to_dict())
+        else:
+            g.payload = model.model_validate_json(request.get_data())
+    except ValidationError as e:
+        return validation_error_response(e)
+    return None
+
+# Rate limit the LLM-backed endpoints per API key, so one client can't tie up
+# every worker with long LLM calls. Keys are hashed before they reach the
+# limiter storage; requests without a key are counted per remote address.
+def rate_limit_key():
+    payload = g.get('payload')
+    for config in (getattr(payload, 'reasoningConfig', None), getattr(payload, 'visionConfig', None)):
+        if config and config.apiKey:
+            return 'key:' + hashlib.sha256(config.apiKey.encode('utf-8')).hexdigest()
+    return 'addr:' + (get_remote_address() or '')
+
+limiter = Limiter(
+    rate_limit_key,
+    app=app,
+    storage_uri=RATE_LIMIT_STORAGE_URI,
+    strategy='sliding-window-counter',
+    headers_enabled=True
+)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f'Request too large (limit {MAX_REQUEST_BYTES // (1024 * 1024)} MB)'}), 413
+
+@app.errorhandler(429)
+def rate_limit_exceeded(e):
+    return jsonify({'error': f'Rate limit exceeded ({e.description}). Please wait and try again.'}), 429
 
 @app.route('/api/analyze', methods=['POST'])
+@limiter.limit(LLM_RATE_LIMIT)
 def analyze():
     try:
-        data = request.json
-        context = data.get('context', '')
-        full_context = data.get('fullContext', '')
-        reasoning_config = data.get('reasoningConfig', {})
-        vision_config = data.get('visionConfig', {})
+        payload = g.payload
+        context = payload.context
+        full_context = payload.fullContext
+        reasoning_config = payload.reasoningConfig
+        vision_config = payload.visionConfig
         
         if not context:
             return jsonify({'error': 'No context provided'}), 400
-        
-        # Check cache first
-        cache_key = generate_cache_key(context, full_context)
-        if cache_key in analysis_cache:
-            print(f"Cache hit for analysis")
-            return jsonify(analysis_cache[cache_key])
 
+        full_context = window_context(full_context, context)
+        
         # Determine Client and Model for Reasoning (Explanation)
-        if reasoning_config and reasoning_config.get('apiKey'):
+        if reasoning_config and reasoning_config.apiKey:
             # print(f"Using custom reasoning config: {reasoning_config.get('model')}") # Removed for security
-            current_reasoning_client = OpenAI(
-                api_key=reasoning_config.get('apiKey'),
-                base_url=reasoning_config.get('baseUrl')
-            )
-            current_reasoning_model = reasoning_config.get('model')
+            current_reasoning_client = get_client(reasoning_config.apiKey, reasoning_config.baseUrl)
+            current_reasoning_model = reasoning_config.model
         else:
             return jsonify({'error': 'Reasoning API configuration missing. Please configure settings.'}), 401
-            
-        # 1. Get Explanation
-        print(f"Requesting explanation...")
-        explanation_prompt = f"""
-        You are an expert physics and mathematics tutor.
-        
-        Target Formula/Concept: "{context}"
-        
-        Full Document Context:
-        "{full_context}"
-        
-        Task:
-        1. Analyze the "Target Formula/Concept" within the context of the "Full Document Context".
-        2. Provide a brief, clear, and insightful explanation. Focus on the "why" and "how".
-        3. **LANGUAGE DETECTION**: Detect the language used in the "Full Document Context" (e.g., English, Chinese, French). 
-        4. **OUTPUT LANGUAGE**: Your explanation MUST be in the SAME language as the "Full Document Context". If the context is mixed, prioritize the language of the descriptive text surrounding the formula.
-        5. **MATH RENDERING**: If your explanation includes mathematical formulas, YOU MUST wrap them in standard LaTeX math delimiters:
-           - Use $...$ for inline math (e.g., $E=mc^2$).
-           - Use $$...$$ for display math.
-           - DO NOT use markdown code blocks for math.
-        6. Return ONLY the explanation text.
-        """
-        
-        explanation_response = current_reasoning_client.chat.completions.create(
-            model=current_reasoning_model,
-            messages=[
-                {"role": "system", "content": "You are a helpful physics tutor."},
-                {"role": "user", "content": explanation_prompt}
-            ],
-            temperature=0.3,
-            top_p=0.9,
-            timeout=30
-        )
-        explanation = explanation_response.choices[0].message.content.strip()
 
-        # 2. Get Visualization Code
+        # Determine Client and Model for Visualization
         # Use vision_config (Multimodal) for visualization if available, as it requires strong coding/spatial capabilities.
-        if vision_config and vision_config.get('apiKey'):
+        if vision_config and vision_config.apiKey:
             # print(f"Using custom vision config for visualization: {vision_config.get('model')}") # Removed for security
-            viz_client = OpenAI(
-                api_key=vision_config.get('apiKey'),
-                base_url=vision_config.get('baseUrl')
-            )
-            viz_model = vision_config.get('model')
+            viz_client = get_client(vision_config.apiKey, vision_config.baseUrl)
+            viz_model = vision_config.model
         else:
             return jsonify({'error': 'Vision API configuration missing. Please configure settings.'}), 401
 
-        print(f"Requesting visualization...")
-        viz_prompt = f"""
-        You are an expert frontend developer and physics simulation specialist.
-        
-        Task: Create a **Dynamic, Interactive Physics Simulation** using HTML5 Canvas and JavaScript.
-        
-        **Source Material**:
-        1. **Target Concept**: "{context}"
-        2. **Physics Logic (Source of Truth for Formulas)**: 
-           "{explanation}"
-        3. **Scenario Context (Source of Truth for Environment/Parameters)**: 
-           "{full_context}"
-        
-        **Implementation Strategy**:
-        1. **Analyze the Physics**: Use the "Physics Logic" to determine the governing equations (kinematics, dynamics, wave equations, etc.).
-        2. **Extract Parameters**: Scan the "Scenario Context" for specific values (e.g., "velocity of 20m/s", "angle of 45 degrees", "mass of 5kg"). 
-           - **CRITICAL**: If the context mentions specific numbers, YOU MUST set them as the initial values for your simulation variables.
-        3. **Design the Visuals**: Use the "Scenario Context" to decide what to draw (e.g., if it mentions a "cliff", draw a cliff; if "spring", draw a spring).
-        
-        CRITICAL REQUIREMENTS:
-        1. **Relevance**: The simulation MUST directly visualize the specific physics concept described.
-           - Use the context to understand specific scenarios.
-           - If it's a projectile, show a projectile.
-           - If it's a wave, show a wave.
-           - If it's a field, show vector fields or particles in a field.
-           - If it's a function, create a function graphing tool.
-           - **DO NOT default to a pendulum or spring unless the concept specifically calls for it.**
-        
-        2. **Physics Accuracy**: Use `requestAnimationFrame` to animate the system based on real physics equations derived from the concept.
-        
-        3. **Interactivity**: 
-           - Include HTML range sliders to adjust key parameters relevant to the specific model (e.g., initial velocity, charge, frequency, mass).
-           - For function graphs, include input fields for function equations and parameter adjustments.
-           - Provide play/pause/reset controls for simulations.
-        
-        4. **Style**: 
-          - Background: Dark (`#000` or `#111`).
-          - Text: Light (`#eee`).
-          - Controls: Minimalist, styled for dark mode, with clear labels.
-        
-        5. **Advanced Features**:
-           - For function graphs: Support multiple functions on the same graph with different colors.
-           - For simulations: Include real-time data display (e.g., position, velocity, energy).
-           - Add zoom and pan functionality for better exploration.
-        
-        6. **Language Adaptation**:
-          - **LANGUAGE DETECTION**: Detect the language used in the "Full Document Context" (e.g., English, Chinese, French).
-          - **OUTPUT LANGUAGE**: Any text displayed in the simulation (labels, titles, slider names, instructions) MUST be in the SAME language as the "Full Document Context". If the context is mixed, prioritize the language of the descriptive text surrounding the formula.
-
-        7. **Output Format**:
-          - Return **ONLY** the HTML snippet containing the container `div`, controls, and the `script` tag.
-          - Do NOT include `<html>`, `<head>`, `<body>`, or markdown code fences.
-          - The root container must have `width: 100%; height: 300px;`.
-        """
-
-        viz_response = viz_client.chat.completions.create(
-            model=viz_model,
-            messages=[
-                {"role": "system", "content": "You are a code generator. Output raw HTML/JS only."},
-                {"role": "user", "content": viz_prompt}
-            ],
-            temperature=0.2,
-            top_p=0.85,
-            timeout=45
+        # Check cache first
+        cache_key = generate_cache_key(
+            normalize_whitespace(context),
+            normalize_whitespace(full_context),
+            current_reasoning_model,
+            viz_model
         )
-        visualization = viz_response.choices[0].message.content.strip()
-        
-        # Cleanup markdown if present
-        if visualization.startswith("```html"):
-            visualization = visualization[7:]
-        if visualization.startswith("```"):
-            visualization = visualization[3:]
-        if visualization.endswith("```"):
-            visualization = visualization[:-3]
+        cached = cache_get(analysis_cache, cache_key)
+        if cached:
+            logger.info("Cache hit for analysis")
+            return sse_response(iter([sse_event('done', **cached)]))
 
-        # Store in cache
-        result = {
-            "explanation": explanation,
-            "visualization": visualization
-        }
-        analysis_cache[cache_key] = result
-        print(f"Cache miss, stored new analysis result")
-        
-        return jsonify(result)
+        explanation_prompt = EXPLANATION_PROMPT.format(context=context, full_context=full_context)
+
+        # Same endpoint and model for both parts: ask for them in one call
+        fused = (
+            (reasoning_config.apiKey, reasoning_config.baseUrl, current_reasoning_model)
+            == (vision_config.apiKey, vision_config.baseUrl, viz_model)
+        )
+        if fused:
+            fused_prompt = FUSED_ANALYSIS_PROMPT.format(
+                explanation_task=explanation_prompt,
+                separator=ANALYSIS_SEPARATOR,
+                visualization_task=VISUALIZATION_PROMPT.format(
+                    context=context,
+                    explanation="(your explanation from PART 1)",
+                    full_context=full_context
+                )
+            )
 
     except Exception as e:
-        print(f"Error in analyze: {e}")
+        logger.exception("Error in analyze")
         return jsonify({'error': str(e)}), 500
 
+    # Stream both completions as SSE frames so the explanation renders as it is generated
+    def generate():
+        while True:
+            future, is_leader = join_inflight(cache_key)
+            if is_leader:
+                break
+            logger.info("Joining in-flight analysis")
+            waited = 0
+            try:
+                while True:
+                    try:
+                        result = future.result(timeout=SSE_KEEPALIVE_SECONDS)
+                        break
+                    except FutureTimeoutError:
+                        waited += SSE_KEEPALIVE_SECONDS
+                        if waited >= INFLIGHT_WAIT_SECONDS:
+                            raise
+                        yield SSE_KEEPALIVE
+            except AnalysisCancelled:
+                # Only the leader's client went away; join again, becoming the leader if no one else has
+                logger.info("In-flight analysis was cancelled, retrying")
+                continue
+            except FutureTimeoutError:
+                logger.warning("Timed out waiting for in-flight analysis")
+                yield sse_event('error', error='Timed out waiting for the analysis. Please try again.')
+                return
+            except Exception as e:
+                logger.exception("Error in analyze")
+                yield sse_event('error', error=str(e))
+                return
+            yield sse_event('done', **result)
+            return
+
+        try:
+            explanation_parts = []
+            visualization_parts = []
+
+            if fused:
+                logger.info("Requesting explanation and visualization...")
+                for part, text in split_analysis_stream(stream_completion(
+                    current_reasoning_client,
+                    model=current_reasoning_model,
+                    messages=[
+                        ANALYSIS_SYSTEM_MESSAGE,
+                        {"role": "user", "content": fused_prompt}
+                    ],
+                    temperature=0.2,
+                    top_p=0.85,
+                    max_tokens=max_tokens(reasoning_config, EXPLANATION_MAX_TOKENS) + max_tokens(vision_config, VISUALIZATION_MAX_TOKENS),
+                    timeout=75
+                )):
+                    (explanation_parts if part == 'explanation' else visualization_parts).append(text)
+                    yield sse_event(f'{part}_delta', text=text)
+            else:
+                # 1. Get Explanation
+                logger.info("Requesting explanation...")
+                for delta in stream_completion(
+                    current_reasoning_client,
+                    model=current_reasoning_model,
+                    messages=[
+                        EXPLANATION_SYSTEM_MESSAGE,
+                        {"role": "user", "content": explanation_prompt}
+                    ],
+                    temperature=0.3,
+                    top_p=0.9,
+                    max_tokens=max_tokens(reasoning_config, EXPLANATION_MAX_TOKENS),
+                    timeout=30
+                ):
+                    explanation_parts.append(delta)
+                    yield sse_event('explanation_delta', text=delta)
+            explanation = ''.join(explanation_parts).strip()
+
+            # 2. Get Visualization Code (also the fallback when a fused response had no separator)
+            if not visualization_parts:
+                logger.info("Requesting visualization...")
+                viz_prompt = VISUALIZATION_PROMPT.format(context=context, explanation=explanation, full_context=full_context)
+
+                for delta in stream_completion(
+                    viz_client,
+                    model=viz_model,
+                    messages=[
+                        VISUALIZATION_SYSTEM_MESSAGE,
+                        {"role": "user", "content": viz_prompt}
+                    ],
+                    temperature=0.2,
+                    top_p=0.85,
+                    max_tokens=max_tokens(vision_config, VISUALIZATION_MAX_TOKENS),
+                    stop=VISUALIZATION_STOP,
+                    timeout=45
+                ):
+                    visualization_parts.append(delta)
+                    yield sse_event('visualization_delta', text=delta)
+            # Cleanup markdown if present
+            visualization = strip_code_fence(''.join(visualization_parts))
+
+            # Store in cache
+            result = {
+                "explanation": explanation,
+                "visualization": visualization
+            }
+            cache_set(analysis_cache, cache_key, result)
+            future.set_result(result)
+            logger.info("Cache miss, stored new analysis result")
+
+            yield sse_event('done', **result)
+
+        except Exception as e:
+            logger.exception("Error in analyze")
+            future.set_exception(e)
+            yield sse_event('error', error=str(e))
+
+        finally:
+            leave_inflight(cache_key, future)
+
+    return sse_response(generate())
+
+# Rule-based Markdown <-> LaTeX conversion. Covers the subset the editor
+# produces (headers, lists, bold/italic, colors); anything else raises
+# UnsupportedConversion and /api/convert falls back to the LLM.
+class UnsupportedConversion(Exception):
+    pass
+
+# Math environments are copied verbatim by both converters
+MATH_ENVIRONMENTS = r'(?:equation|align|alignat|gather|multline|flalign|eqnarray|cases|[pbBvV]?matrix|array|split)\*?'
+
+# Spans copied verbatim: page markers, display/inline math, math environments
+LATEX_PROTECTED_RE = re.compile(
+    r'<!--.*?-->'
+    r'|\$\$.*?\$\$'
+    r'|\\\[.*?\\\]'
+    r'|\\\(.*?\\\)'
+    r'|(?<![\\$])\$(?!\d)(?:\\.|[^$\\])+?\$'
+    r'|\\begin\{(' + MATH_ENVIRONMENTS + r')\}.*?\\end\{\1\}',
+    re.DOTALL
+)
+
+# Markdown input may embed raw LaTeX environments of any kind; keep them all
+MARKDOWN_PROTECTED_RE = re.compile(
+    LATEX_PROTECTED_RE.pattern + r'|\\begin\{(\w+\*?)\}.*?\\end\{\2\}',
+    re.DOTALL
+)
+
+PLACEHOLDER_RE = re.compile(r'\x00(\d+)\x00')
+
+SECTION_COMMANDS = ['section', 'subsection', 'subsubsection', 'paragraph', 'subparagraph', 'subparagraph']
+
+FONT_COLOR_RE = re.compile(r'<font\s+color\s*=\s*["\']?([^"\'\s>]+)["\']?\s*>(.*?)</font>', re.DOTALL | re.IGNORECASE)
+SPAN_COLOR_RE = re.compile(r'<span\s+style\s*=\s*["\']\s*color\s*:\s*([^;"\']+?)\s*;?\s*["\']\s*>(.*?)</span>', re.DOTALL | re.IGNORECASE)
+TEX_COLOR_GROUP_RE = re.compile(r'\{\\color\{([^{}]*)\}\s*((?:[^{}]|\{[^{}]*\})*)\}')
+
+MARKDOWN_HEADING_RE = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+MARKDOWN_LIST_ITEM_RE = re.compile(r'^(\s*)([-*+]|\d+[.)])\s+(.*)$')
+UNSUPPORTED_MARKDOWN_RE = re.compile(
+    r'^\s*```'                              # code blocks
+    r'|^\s*\|.*\|\s*$'                       # tables
+    r'|^\s*>'                                # block quotes
+    r'|^\s*(?:-{3,}|\*{3,}|_{3,})\s*$'       # horizontal rules
+    r'|!?\[[^\]]*\]\([^)]*\)'                # links and images
+    r'|</?[a-zA-Z][^>]*>',                   # leftover HTML
+    re.MULTILINE
+)
+# LaTeX outside math is allowlisted: any other control sequence, a non-list
+# environment, a % comment or a ~ tie sends the document to the LLM instead
+SUPPORTED_LATEX_COMMANDS = {
+    *SECTION_COMMANDS, 'begin', 'end', 'item', 'textbf', 'textit', 'emph', 'texttt', 'textcolor',
+    'textasciicircum', 'textasciitilde', 'textbackslash', '%', '&', '#', '_', '$', '{', '}'
+}
+LATEX_CONTROL_RE = re.compile(r'\\([a-zA-Z]+|.)', re.DOTALL)
+UNSUPPORTED_LATEX_RE = re.compile(r'\\begin\{(?!itemize\}|enumerate\})|(?<!\\)[%~]')
+LATEX_LIST_TOKEN_RE = re.compile(r'(\\begin\{(?:itemize|enumerate)\}|\\end\{(?:itemize|enumerate)\}|\\item(?:\[[^\]]*\])?)')
+
+def protect_spans(text, pattern):
+    stash = []
+    def stash_match(match):
+        stash.append(match.group(0))
+        return f'\x00{len(stash) - 1}\x00'
+    return pattern.sub(stash_match, text), stash
+
+def restore_spans(text, stash):
+    return PLACEHOLDER_RE.sub(lambda m: stash[int(m.group(1))], text)
+
+def html_color_to_tex(match):
+    color, text = match.group(1).strip(), match.group(2)
+    if re.fullmatch(r'#[0-9a-fA-F]{6}', color):
+        return f'\\textcolor[HTML]{{{color[1:].upper()}}}{{{text}}}'
+    return f'\\textcolor{{{color}}}{{{text}}}'
+
+# A $ left over once math spans are stashed is unpaired or ambiguous ("$10",
+# "$2x$"); the LLM decides whether it is currency or math
+UNPAIRED_DOLLAR_RE = re.compile(r'(?<!\\)\$')
+
+# Characters that are special in LaTeX text mode. Inline code escapes all of
+# them; ordinary text may carry raw LaTeX commands, so it only escapes the ones
+# that never start markup there.
+LATEX_SPECIAL_CHARS = {
+    '\\': r'\textbackslash{}', '{': r'\{', '}': r'\}', '$': r'\$', '&': r'\&', '%': r'\%',
+    '#': r'\#', '_': r'\_', '^': r'\textasciicircum{}', '~': r'\textasciitilde{}'
+}
+LATEX_SPECIAL_RE = re.compile('|'.join(re.escape(char) for char in LATEX_SPECIAL_CHARS))
+LATEX_ESCAPED_RE = re.compile('|'.join(re.escape(escaped) for escaped in LATEX_SPECIAL_CHARS.values()))
+LATEX_UNESCAPED = {escaped: char for char, escaped in LATEX_SPECIAL_CHARS.items()}
+INLINE_CODE_PLACEHOLDER_RE = re.compile(r'\x01(\d+)\x01')
+
+def escape_latex(text):
+    return LATEX_SPECIAL_RE.sub(lambda m: LATEX_SPECIAL_CHARS[m.group(0)], text)
+
+def unescape_latex(text):
+    return LATEX_ESCAPED_RE.sub(lambda m: LATEX_UNESCAPED[m.group(0)], text)
+
+def markdown_inline_to_latex(text):
+    code = []
+    def stash_code(match):
+        code.append('\\texttt{' + escape_latex(match.group(1)) + '}')
+        return f'\x01{len(code) - 1}\x01'
+    text = re.sub(r'`([^`]+)`', stash_code, text)
+    text = re.sub(r'\*\*(.+?)\*\*|(?<!\w)__(.+?)__(?!\w)', lambda m: '\\textbf{' + (m.group(1) or m.group(2)) + '}', text)
+    text = re.sub(r'(?<![*\w])\*(?![\s*])(.+?)(?<![\s*])\*(?!\*)', lambda m: '\\textit{' + m.group(1) + '}', text)
+    # Intraword underscores (snake_case) are not emphasis
+    text = re.sub(r'(?<![_\w])_(?![\s_])(.+?)(?<![\s_])_(?![_\w])', lambda m: '\\textit{' + m.group(1) + '}', text)
+    text = re.sub(r'(?<!\\)([%&#_])', r'\\\1', text)
+    text = re.sub(r'(?<!\\)\^', r'\\textasciicircum{}', text)
+    return INLINE_CODE_PLACEHOLDER_RE.sub(lambda m: code[int(m.group(1))], text)
+
+def markdown_to_latex(content):
+    content = FONT_COLOR_RE.sub(html_color_to_tex, content)
+    content = SPAN_COLOR_RE.sub(html_color_to_tex, content)
+    text, stash = protect_spans(content, MARKDOWN_PROTECTED_RE)
+    if UNSUPPORTED_MARKDOWN_RE.search(text):
+        raise UnsupportedConversion('Markdown content outside the supported subset')
+    if UNPAIRED_DOLLAR_RE.search(text):
+        raise UnsupportedConversion('Unpaired or ambiguous $')
+
+    lines = text.split('\n')
+    output = []
+    open_lists = []  # (indent, environment)
+
+    def close_lists(indent=-1):
+        while open_lists and open_lists[-1][0] > indent:
+            output.append('    ' * (len(open_lists) - 1) + f'\\end{{{open_lists.pop()[1]}}}')
+
+    for i, line in enumerate(lines):
+        item = MARKDOWN_LIST_ITEM_RE.match(line)
+        if item:
+            indent = len(item.group(1).expandtabs(4))
+            environment = 'itemize' if item.group(2) in '-*+' else 'enumerate'
+            close_lists(indent)
+            if open_lists and open_lists[-1][0] == indent and open_lists[-1][1] != environment:
+                close_lists(indent - 1)
+            if not open_lists or open_lists[-1][0] < indent:
+                output.append('    ' * len(open_lists) + f'\\begin{{{environment}}}')
+                open_lists.append((indent, environment))
+            output.append('    ' * len(open_lists) + '\\item ' + markdown_inline_to_latex(item.group(3)))
+            continue
+
+        if open_lists:
+            if not line.strip():
+                # Keep a list open across blank lines only if it continues afterwards
+                following = next((l for l in lines[i + 1:] if l.strip()), '')
+                if MARKDOWN_LIST_ITEM_RE.match(following) or following.startswith(' '):
+                    continue
+                close_lists()
+            elif line.startswith(' '):
+                output.append('    ' * len(open_lists) + markdown_inline_to_latex(line.strip()))
+                continue
+            else:
+                close_lists()
+
+        heading = MARKDOWN_HEADING_RE.match(line)
+        if heading:
+            command = SECTION_COMMANDS[len(heading.group(1)) - 1]
+            output.append(f'\\{command}{{{markdown_inline_to_latex(heading.group(2))}}}')
+        else:
+            output.append(markdown_inline_to_latex(line))
+    close_lists()
+
+    return restore_spans('\n'.join(output), stash)
+
+def replace_command(text, name, render):
+    """Replace \\name{arg} (and \\name*{arg}) using balanced-brace matching."""
+    pattern = re.compile(r'\\' + name + r'\*?\s*\{')
+    result = []
+    position = 0
+    while True:
+        match = pattern.search(text, position)
+        if not match:
+            break
+        depth, end = 1, match.end()
+        while end < len(text) and depth:
+            if text[end] == '\\':
+                end += 2
+                continue
+            depth += {'{': 1, '}': -1}.get(text[end], 0)
+            end += 1
+        if depth:
+            raise UnsupportedConversion(f'Unbalanced braces after \\{name}')
+        result.append(text[position:match.start()])
+        result.append(render(text[match.end():end - 1]))
+        position = end
+    result.append(text[position:])
+    return ''.join(result)
+
+def latex_inline_to_markdown(text):
+    # Spans are bracketed with \x02...\x03 so runs like \textit{x}\textbf{y} are caught:
+    # Markdown can't parse touching markers (*x***y**)
+    text = replace_command(text, 'textbf', lambda arg: f'\x02**{arg}**\x03')
+    text = replace_command(text, 'textit', lambda arg: f'\x02*{arg}*\x03')
+    text = replace_command(text, 'emph', lambda arg: f'\x02*{arg}*\x03')
+    text = replace_command(text, 'texttt', lambda arg: f'\x02`{unescape_latex(arg)}`\x03')
+    if '\x03\x02' in text:
+        raise UnsupportedConversion('Adjacent inline formatting')
+    text = text.replace('\x02', '').replace('\x03', '')
+    text = re.sub(r'\\([%&])', r'\1', text)
+    text = text.replace(r'\textasciicircum{}', '^').replace(r'\textasciitilde{}', '~')
+    text = text.replace(r'\textbackslash{}', '\\\\')
+    text = re.sub(r'(?<=\w)\\_(?=\w)', '_', text)
+    # A '#' at the start of a line would become a heading, and a bare '$' could
+    # open math; those stay backslash-escaped, which Markdown renders literally
+    return re.sub(r'(^[ \t]*)?\\#', lambda m: m.group(0) if m.group(1) is not None else '#', text, flags=re.MULTILINE)
+
+def latex_lists_to_markdown(text):
+    output = []
+    stack = []  # [environment, item number]
+    for token in LATEX_LIST_TOKEN_RE.split(text):
+        if token.startswith('\\begin'):
+            if not stack:
+                output.append('\n')
+            stack.append(['enumerate' if 'enumerate' in token else 'itemize', 0])
+        elif token.startswith('\\end'):
+            if not stack:
+                raise UnsupportedConversion('Unmatched list environment')
+            stack.pop()
+            if not stack:
+                output.append('\n')
+        elif token.startswith('\\item'):
+            if not stack:
+                raise UnsupportedConversion('\\item outside a list')
+            stack[-1][1] += 1
+            marker = f'{stack[-1][1]}.' if stack[-1][0] == 'enumerate' else '-'
+            output.append('\n' + '    ' * (len(stack) - 1) + marker + ' ')
+        elif stack:
+            output.append(' '.join(token.split()))
+        else:
+            output.append(token)
+    if stack:
+        raise UnsupportedConversion('Unclosed list environment')
+    return re.sub(r'\n{3,}', '\n\n', ''.join(output))
+
+def latex_to_markdown(content):
+    content = TEX_COLOR_GROUP_RE.sub(lambda m: f'\\textcolor{{{m.group(1)}}}{{{m.group(2).strip()}}}', content)
+    text, stash = protect_spans(content, LATEX_PROTECTED_RE)
+    if UNSUPPORTED_LATEX_RE.search(text) or any(
+        command not in SUPPORTED_LATEX_COMMANDS for command in LATEX_CONTROL_RE.findall(text)
+    ):
+        raise UnsupportedConversion('LaTeX content outside the supported subset')
+    if UNPAIRED_DOLLAR_RE.search(text):
+        raise UnsupportedConversion('Unpaired or ambiguous $')
+
+    for level, command in enumerate(SECTION_COMMANDS[:5], start=1):
+        text = replace_command(text, command, lambda arg, level=level: '\n' + '#' * level + ' ' + ' '.join(arg.split()) + '\n')
+    text = latex_lists_to_markdown(text)
+    text = latex_inline_to_markdown(text)
+    text = re.sub(r'[ \t]+\n', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+
+    return restore_spans(text, stash)
+
 @app.route('/api/convert', methods=['POST'])
 def convert_format():
     try:
-        data = request.json
-        content = data.get('content', '')
-        target_format = data.get('targetFormat', 'tex') # 'tex' or 'md'
-        reasoning_config = data.get('reasoningConfig', {})
+        payload = g.payload
+        content = payload.content
+        target_format = payload.targetFormat # 'tex' or 'md'
+        reasoning_config = payload.reasoningConfig
         
         if not content:
             return jsonify({'error': 'No content provided'}), 400
 
+        # Structural conversion is mechanical; only fall back to the LLM for unsupported syntax
+        try:
+            if target_format == 'tex':
+                converted = markdown_to_latex(content)
+            else: # md
+                converted = latex_to_markdown(content)
+            return jsonify({'converted': converted.strip()})
+        except UnsupportedConversion as e:
+            logger.info("Rule-based conversion unavailable (%s), falling back to LLM", e)
+
         # Determine Client
-        if reasoning_config and reasoning_config.get('apiKey'):
+        if reasoning_config and reasoning_config.apiKey:
             # print(f"Using custom reasoning config for conversion: {reasoning_config.get('model')}") # Removed for security
-            client = OpenAI(
-                api_key=reasoning_config.get('apiKey'),
-                base_url=reasoning_config.get('baseUrl')
-            )
-            model = reasoning_config.get('model')
+            client = get_client(reasoning_config.apiKey, reasoning_config.baseUrl)
+            model = reasoning_config.model
         else:
              return jsonify({'error': 'Reasoning API configuration missing. Please configure settings.'}), 401
 
-        print(f"Requesting format conversion to {target_format}...")
+        # Check cache first
+        cache_key = generate_cache_key(content, target_format, model)
+        cached = cache_get(convert_cache, cache_key)
+        if cached:
+            logger.info("Cache hit for conversion")
+            return jsonify(cached)
+
+        logger.info("Requesting format conversion to %s...", target_format)
         
         if target_format == 'tex':
-            prompt = f"""
-            Convert the following Markdown/LaTeX mixed content into a pure, compile-ready LaTeX document body.
-            
-            Rules:
-            1. Convert Markdown headers (#, ##) to LaTeX sections (\section, \subsection).
-            2. Convert Markdown lists (- , 1.) to LaTeX lists (itemize, enumerate).
-            3. Convert Markdown bold/italic to LaTeX (\textbf, \textit).
-            4. **COLOR PRESERVATION**:
-               - Keep `\textcolor{{color}}{{text}}` as is.
-               - Convert `<font color="color">text</font>` to `\textcolor{{color}}{{text}}` (if present).
-               - Convert `<span style="color: color">text</span>` to `\textcolor{{color}}{{text}}` (if present).
-            5. Keep existing LaTeX math ($...$, $$...$$) unchanged.
-            6. Return ONLY the converted LaTeX body code. Do NOT wrap in \documentclass.
-            7. Do not include markdown code fences.
-            
-            Content:
-            "{content}"
-            """
+            prompt = CONVERT_TO_LATEX_PROMPT.format(content=content)
         else: # md
-            prompt = f"""
-            Convert the following LaTeX content into clean Markdown.
-            
-            Rules:
-            1. **COLOR PRESERVATION (HIGHEST PRIORITY)**: 
-               - **KEEP** `\textcolor{{color}}{{text}}` commands AS IS. 
-               - **DO NOT** convert color to bold (`**`) or italic (`*`).
-               - **DO NOT** convert color to HTML.
-               - Convert `{{\color{{color}} text}}` to `\textcolor{{color}}{{text}}`.
-            2. Convert LaTeX sections (\section, \subsection) to Markdown headers (#, ##).
-            3. Convert LaTeX lists to Markdown lists.
-            4. Convert LaTeX text formatting (\textbf, \textit) to Markdown (**...**, *...*).
-               - Only convert `\textbf` and `\textit`. DO NOT touch `\textcolor`.
-            5. Keep LaTeX math ($...$, $$...$$) unchanged.
-            6. Return ONLY the converted Markdown content.
-            7. Do not include markdown code fences.
-            
-            Content:
-            "{content}"
-            """
+            prompt = CONVERT_TO_MARKDOWN_PROMPT.format(content=content)
 
         response = client.chat.completions.create(
             model=model,
             messages=[
-                {"role": "system", "content": "You are a document format converter."},
+                CONVERT_SYSTEM_MESSAGE,
                 {"role": "user", "content": prompt}
             ],
             temperature=0.1,
             top_p=0.8,
             timeout=30
         )
-        converted = response.choices[0].message.content.strip()
-        
         # Cleanup
-        if converted.startswith("```latex") or converted.startswith("```markdown"):
-            converted = converted.split('\n', 1)[1]
-        if converted.startswith("```"):
-            converted = converted[3:]
-        if converted.endswith("```"):
-            converted = converted[:-3]
+        converted = strip_code_fence(response.choices[0].message.content)
 
-        return jsonify({'converted': converted.strip()})
+        # Store in cache
+        result = {'converted': converted}
+        cache_set(convert_cache, cache_key, result)
+        logger.info("Cache miss, stored new conversion result")
+
+        return jsonify(result)
 
     except Exception as e:
-        print(f"Error in convert: {e}")
+        logger.exception("Error in convert")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/ocr', methods=['POST'])
+@limiter.limit(LLM_RATE_LIMIT)
 def ocr():
     try:
-        data = request.json
-        image_data = data.get('image', '') # Expecting base64 string
-        vision_config = data.get('visionConfig', {})
-        previous_context = data.get('previousContext', '')
-        next_context = data.get('nextContext', '')
+        payload = g.payload
+        image_data = None
+        if request.mimetype == 'multipart/form-data':
+            # Raw image bytes, no base64 string to decode
+            upload = request.files.get('image')
+            image_type, image_bytes = (upload.mimetype, upload.read()) if upload else ('', b'')
+        else:
+            if not payload.image:
+                return jsonify({'error': 'No image provided'}), 400
+            decoded = decode_image_data_url(payload.image) # Expecting base64 data URL
+            if decoded is None:
+                # Anything else (e.g. an https:// image URL) is forwarded to the model unchanged
+                image_data = payload.image
+                image_type, image_bytes = '', payload.image.encode()
+            else:
+                image_type, image_bytes = decoded
+        vision_config = payload.visionConfig
+        previous_context = payload.previousContext
+        next_context = payload.nextContext
         
-        if not image_data:
+        if not image_bytes:
             return jsonify({'error': 'No image provided'}), 400
 
         # Check cache first
-        cache_key = generate_ocr_cache_key(image_data, previous_context, next_context)
-        if cache_key in ocr_cache:
-            print(f"Cache hit for OCR")
-            return jsonify(ocr_cache[cache_key])
+        cache_key = generate_ocr_cache_key(image_bytes, previous_context, next_context)
+        cached = cache_get(ocr_cache, cache_key)
+        if cached:
+            logger.info("Cache hit for OCR")
+            return jsonify(cached)
 
         # Determine Client and Model for Vision
-        if vision_config and vision_config.get('apiKey'):
+        if vision_config and vision_config.apiKey:
             # print(f"Using custom vision config: {vision_config.get('model')}") # Removed for security
-            current_vision_client = OpenAI(
-                api_key=vision_config.get('apiKey'),
-                base_url=vision_config.get('baseUrl')
-            )
-            current_vision_model = vision_config.get('model')
+            current_vision_client = get_client(vision_config.apiKey, vision_config.baseUrl)
+            current_vision_model = vision_config.model
         else:
             return jsonify({'error': 'Vision API configuration missing. Please configure settings.'}), 401
 
         # Construct Contextual Prompt
-        system_prompt = """Transcribe this handwritten note into valid XeLaTeX code with high accuracy.
-
-DETAILED RECOGNITION RULES:
-1. **Content Extraction**: Capture ALL visible content, including handwritten text, printed text, mathematical formulas, symbols, diagrams, and annotations.
-2. **LaTeX Formatting**: 
-   - Return ONLY the body content (formulas, text, etc.).
-   - Do NOT include \documentclass, \begin{document}, \maketitle, or \end{document}.
-   - Assume standard packages (amsmath, amssymb, geometry, xcolor) are already loaded.
-3. **Mathematical Formula Recognition**: 
-   - Use standard LaTeX math mode ($...$ for inline, $$...$$ for display).
-   - For complex formulas, use appropriate LaTeX environments (e.g., align, equation, cases).
-   - Correctly identify and format mathematical symbols, operators, and functions.
-   - Recognize subscripts and superscripts accurately (e.g., x_1, x^2, x_1^2).
-   - For fractions, use \frac{numerator}{denominator} or \dfrac for display-style fractions.
-   - For integrals, use proper LaTeX syntax (e.g., \int, \iint, \oint) with correct limits.
-   - For vectors and matrices, use appropriate notation (e.g., \vec{v}, \mathbf{M}, \begin{matrix}).
-   - For derivatives, use \frac{d}{dx} or \frac{\partial}{\partial x} as appropriate.
-4. **Contextual Correction**: Correct any obvious physical or mathematical errors based on context, but preserve the original intent of the writing.
-5. **Output Format**: Return ONLY the LaTeX code, no markdown fencing.
-6. **COLOR DETECTION (ENHANCED)**: 
-   - **Color Identification**: Carefully analyze the color of each handwritten stroke, considering both hue and intensity.
-   - **Color Categories**: Recognize the following colors with high accuracy:
-     * Red (\textcolor{red}{...})
-     * Blue (\textcolor{blue}{...})
-     * Green (\textcolor{green}{...})
-     * Orange (\textcolor{orange}{...})
-     * Purple (\textcolor{purple}{...})
-     * Black (no color command)
-     * Gray (no color command)
-     * White (no color command)
-   - **Color Consistency**: Apply color commands consistently to entire words, phrases, or formulas written in the same color.
-   - **Mixed Colors**: If different parts of the same formula or text are in different colors, apply color commands to each part separately.
-   - **Background Consideration**: Consider the background color when determining the text color (e.g., light text on dark background).
-7. **Layout Preservation**: Maintain the original layout and structure of the content, including line breaks, indentation, and spacing.
-8. **Symbol Recognition**: Accurately identify and transcribe special symbols, Greek letters, and mathematical notation.
-9. **Handwriting Variations**: Account for different handwriting styles and variations in character formation.
-10. **Context Integration**: Use the provided previous and next context to ensure accurate transcription and proper formatting.
-"""
-
-        
+        prompt_parts = [OCR_PROMPT]
         if previous_context:
-            system_prompt += f"\n\nPREVIOUS CONTEXT (The text immediately preceding this image):\n...{previous_context}\n\nINSTRUCTION: Ensure your transcription flows naturally from this previous context."
-            
+            prompt_parts += (OCR_PREVIOUS_CONTEXT[0], previous_context, OCR_PREVIOUS_CONTEXT[1])
         if next_context:
-            system_prompt += f"\n\nNEXT CONTEXT (The text immediately following this image):\n{next_context}...\n\nINSTRUCTION: Ensure your transcription connects smoothly to this next context."
+            prompt_parts += (OCR_NEXT_CONTEXT[0], next_context, OCR_NEXT_CONTEXT[1])
+        system_prompt = ''.join(prompt_parts)
+
+        if image_data is None:
+            # Smaller upload, fewer image tokens, faster model response
+            try:
+                image_type, image_bytes = shrink_image(image_bytes, image_type)
+            except Image.DecompressionBombError:
+                # Too many pixels to decode safely; don't forward it to the model either
+                return jsonify({'error': 'Image too large'}), 400
+            if not image_type.startswith('image/'):
+                return jsonify({'error': 'Unsupported image format'}), 400
+            image_data = f'data:{image_type};base64,' + base64.b64encode(image_bytes).decode('ascii')
 
         # Use Gemini/Custom for Vision/OCR as it has strong multimodal capabilities
-        print(f"Requesting OCR with context...")
+        logger.info("Requesting OCR with context...")
         response = current_vision_client.chat.completions.create(
             model=current_vision_model,
             messages=[
@@ -379,43 +1176,41 @@ DETAILED RECOGNITION RULES:
                     ],
                 }
             ],
-            max_tokens=2000,
+            max_tokens=max_tokens(vision_config, OCR_MAX_TOKENS),
             temperature=0.1,
             top_p=0.7,
             timeout=60
         )
 
-        latex_code = response.choices[0].message.content.strip()
         # Remove markdown code blocks if present
-        if latex_code.startswith("```latex"):
-            latex_code = latex_code[8:]
-        if latex_code.startswith("```"):
-            latex_code = latex_code[3:]
-        if latex_code.endswith("```"):
-            latex_code = latex_code[:-3]
-            
+        latex_code = strip_code_fence(response.choices[0].message.content)
+
         # Store in cache
-        result = {'latex': latex_code.strip()}
-        ocr_cache[cache_key] = result
-        print(f"Cache miss, stored new OCR result")
+        result = {'latex': latex_code}
+        cache_set(ocr_cache, cache_key, result)
+        logger.info("Cache miss, stored new OCR result")
             
         return jsonify(result)
 
     except Exception as e:
-        print(f"Error in ocr: {e}")
+        logger.exception("Error in ocr")
         return jsonify({'error': str(e)}), 500
 
 # Serve React App
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
+# Convenience for `python app.py`; behind nginx (see nginx.conf) set
+# PRINCIPIA_SERVE_STATIC=0 so static files never reach a Python worker.
 def serve(path):
     if path != "" and os.path.exists(app.static_folder + '/' + path):
         return send_from_directory(app.static_folder, path)
     else:
         return send_from_directory(app.static_folder, 'index.html')
 
+if SERVE_STATIC:
+    app.add_url_rule('/', 'serve', serve, defaults={'path': ''})
+    app.add_url_rule('/<path:path>', 'serve', serve)
+
 if __name__ == "__main__":
-    print(f"--------------------------------------------------")
-    print(f"The Principia Backend Running on Port {PORT}")
-    print(f"--------------------------------------------------")
+    logger.info("--------------------------------------------------")
+    logger.info("The Principia Backend Running on Port %s", PORT)
+    logger.info("--------------------------------------------------")
     app.run(port=PORT, debug=True, use_reloader=False)
\ No newline at end of file
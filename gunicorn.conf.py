@@ -0,0 +1,25 @@
+# Gunicorn configuration for server deployments (Linux/macOS):
+#
+#     gunicorn -c gunicorn.conf.py app:app
+#
+# Each request spends most of its time waiting on an LLM API, so workers use
+# gevent: one worker keeps many requests (and their streamed responses) in
+# flight at once instead of blocking on a single upstream call. The gevent
+# worker monkey-patches the standard library (sockets, threading, ...) when
+# it boots, before app.py is imported, so httpx and the cache locks in app.py
+# cooperate with it without any changes.
+#
+# The desktop build (PyInstaller on Windows) and `python app.py` keep using
+# Flask's built-in threaded server.
+import os
+
+bind = os.environ.get('PRINCIPIA_BIND', '0.0.0.0:8000')
+
+worker_class = 'gevent'
+workers = int(os.environ.get('PRINCIPIA_WORKERS', os.cpu_count() or 1))
+worker_connections = 1000
+
+# Longer than the slowest LLM call chain (explanation + visualization)
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
@@ -27,13 +27,24 @@ interface AppSettings {
     vision: ApiConfig;
 }
 
-interface OCRRequestBody {
-  image: string;
+interface OCRRequestFields {
   visionConfig?: ApiConfig;
   previousContext?: string;
   nextContext?: string;
 }
 
+// OCR images are uploaded as multipart form data so the backend receives raw bytes
+// instead of a base64 string embedded in JSON
+const buildOCRFormData = async (imageData: string, fields: OCRRequestFields): Promise<FormData> => {
+  const image = await (await fetch(imageData)).blob();
+  const form = new FormData();
+  form.append('image', image, 'image');
+  if (fields.visionConfig) form.append('visionConfig', JSON.stringify(fields.visionConfig));
+  if (fields.previousContext) form.append('previousContext', fields.previousContext);
+  if (fields.nextContext) form.append('nextContext', fields.nextContext);
+  return form;
+};
+
 interface ConvertRequestBody {
   content: string;
   targetFormat: 'tex' | 'md';
@@ -133,7 +144,7 @@ function App() {
     type: lang === 'en' ? 'Type' : '输入',
     image: lang === 'en' ? 'Image' : '图像',
     explain: lang === 'en' ? 'Explain' : '解释',
-    switchingFormat: lang === 'en' ? `Switching to ${downloadFormat.toUpperCase()} format will use AI to restructure your document. \n\nThis process will rewrite formatting (headers, lists, etc.) to match ${downloadFormat === 'tex' ? 'LaTeX' : 'Markdown'} standards.\n\nDo you want to proceed?` : `切换到 ${downloadFormat.toUpperCase()} 格式将使用 AI 重构您的文档。\n\n此过程将重写格式（标题、列表等）以匹配 ${downloadFormat === 'tex' ? 'LaTeX' : 'Markdown'} 标准。\n\n是否继续？`
+    switchingFormat: lang === 'en' ? `Switching to ${downloadFormat.toUpperCase()} format will restructure your document. \n\nThis process will rewrite formatting (headers, lists, etc.) to match ${downloadFormat === 'tex' ? 'LaTeX' : 'Markdown'} standards.\n\nDo you want to proceed?` : `切换到 ${downloadFormat.toUpperCase()} 格式将重构您的文档。\n\n此过程将重写格式（标题、列表等）以匹配 ${downloadFormat === 'tex' ? 'LaTeX' : 'Markdown'} 标准。\n\n是否继续？`
   };
 
   // Load language preference
@@ -289,15 +300,14 @@ function App() {
     setOcrTaskId(null);
     try {
         // Handle legacy single-image recognition (or full canvas fallback)
-        const body: OCRRequestBody = { image: imageData };
+        const fields: OCRRequestFields = {};
         if (settings?.vision?.apiKey) {
-            body.visionConfig = settings.vision;
+            fields.visionConfig = settings.vision;
         }
 
         const response = await fetch(`${API_BASE_URL}/api/ocr`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(body)
+            body: await buildOCRFormData(imageData, fields)
         });
         
         if (!response.ok) throw new Error('OCR Failed');
@@ -457,19 +467,17 @@ function App() {
               }
 
               // 2. Call API
-              const body: OCRRequestBody = { 
-                  image: imageData,
+              const fields: OCRRequestFields = { 
                   previousContext,
                   nextContext
               };
               if (settings?.vision?.apiKey) {
-                  body.visionConfig = settings.vision;
+                  fields.visionConfig = settings.vision;
               }
 
               const response = await fetch(`${API_BASE_URL}/api/ocr`, {
                   method: 'POST',
-                  headers: { 'Content-Type': 'application/json' },
-                  body: JSON.stringify(body)
+                  body: await buildOCRFormData(imageData, fields)
               });
 
               if (!response.ok) throw new Error(`OCR Failed for Page ${pageNum}`);
@@ -520,7 +528,7 @@ function App() {
     }
 
     // Update switchingFormat in the translation object
-    const switchingFormat = lang === 'en' ? `Switching to ${targetFormat.toUpperCase()} format will use AI to restructure your document. \n\nThis process will rewrite formatting (headers, lists, etc.) to match ${targetFormat === 'tex' ? 'LaTeX' : 'Markdown'} standards.\n\nDo you want to proceed?` : `切换到 ${targetFormat.toUpperCase()} 格式将使用 AI 重构您的文档。\n\n此过程将重写格式（标题、列表等）以匹配 ${targetFormat === 'tex' ? 'LaTeX' : 'Markdown'} 标准。\n\n是否继续？`;
+    const switchingFormat = lang === 'en' ? `Switching to ${targetFormat.toUpperCase()} format will restructure your document. \n\nThis process will rewrite formatting (headers, lists, etc.) to match ${targetFormat === 'tex' ? 'LaTeX' : 'Markdown'} standards.\n\nDo you want to proceed?` : `切换到 ${targetFormat.toUpperCase()} 格式将重构您的文档。\n\n此过程将重写格式（标题、列表等）以匹配 ${targetFormat === 'tex' ? 'LaTeX' : 'Markdown'} 标准。\n\n是否继续？`;
 
     const confirmSwitch = window.confirm(switchingFormat);
 
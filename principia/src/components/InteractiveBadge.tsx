@@ -89,8 +89,34 @@ export function InteractiveBadge({ id, content, title = "Physics Model Analysis"
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify(body)
         });
-        if (!response.ok) throw new Error("Analysis failed");
-        const data = await response.json();
+        if (!response.ok || !response.body) throw new Error("Analysis failed");
+
+        // Read the Server-Sent Events stream, showing the explanation as it arrives
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let partialExplanation = '';
+        let data: { explanation: string, visualization: string } | null = null;
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const frames = buffer.split('\n\n');
+            buffer = frames.pop() ?? '';
+            for (const frame of frames) {
+                if (!frame.startsWith('data: ')) continue;
+                const event = JSON.parse(frame.slice(6));
+                if (event.type === 'explanation_delta') {
+                    partialExplanation += event.text;
+                    setLocalAnalysis({ explanation: partialExplanation, visualization: "" });
+                } else if (event.type === 'done') {
+                    data = { explanation: event.explanation, visualization: event.visualization };
+                } else if (event.type === 'error') {
+                    throw new Error(event.error);
+                }
+            }
+        }
+        if (!data) throw new Error("Analysis stream ended unexpectedly");
         
         if (onAnalysisComplete) {
             onAnalysisComplete(id, data);
@@ -203,7 +229,7 @@ export function InteractiveBadge({ id, content, title = "Physics Model Analysis"
               </div>
               
               <div className="text-sm text-muted-foreground mb-3 leading-relaxed">
-                {isLoading ? (
+                {isLoading && !analysis ? (
                     <div className="flex items-center gap-2 text-muted-foreground py-4">
                         <Loader2 size={16} className="animate-spin" />
                         <span>Analyzing with AI...</span>
@@ -218,6 +244,12 @@ export function InteractiveBadge({ id, content, title = "Physics Model Analysis"
                               {analysis.explanation}
                             </ReactMarkdown>
                         </div>
+                        {isLoading && (
+                            <div className="flex items-center gap-2 text-muted-foreground">
+                                <Loader2 size={16} className="animate-spin" />
+                                <span>Generating visualization...</span>
+                            </div>
+                        )}
                         {analysis.visualization && (
                             <div className="rounded-lg overflow-hidden border border-border bg-card relative min-h-[200px]">
                                 <iframe 
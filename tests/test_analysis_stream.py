@@ -0,0 +1,103 @@
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+import app
+from app import ANALYSIS_SEPARATOR, split_analysis_stream, strip_code_fence
+
+EXPLANATION = 'Newton:\n```python\nprint(1)\n```\nmore'
+VISUALIZATION = '<div>v</div>'
+FUSED_OUTPUT = f'{EXPLANATION}\n{ANALYSIS_SEPARATOR}\n```html\n{VISUALIZATION}\n```\ntrailing text'
+
+
+def deltas(text, size):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def split(pieces):
+    parts = list(split_analysis_stream(pieces))
+    explanation = ''.join(text for part, text in parts if part == 'explanation')
+    visualization = ''.join(text for part, text in parts if part == 'visualization')
+    return explanation, visualization
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 11, len(FUSED_OUTPUT)])
+def test_separator_split_across_deltas(size):
+    explanation, visualization = split(deltas(FUSED_OUTPUT, size))
+    assert explanation.strip() == EXPLANATION
+    assert strip_code_fence(visualization) == VISUALIZATION
+
+
+def test_code_block_in_explanation_does_not_end_stream():
+    explanation, visualization = split(piece for piece in [EXPLANATION, '\n', ANALYSIS_SEPARATOR, '\n```html\n', VISUALIZATION, '\n```\n'])
+    assert explanation.strip() == EXPLANATION
+    assert strip_code_fence(visualization) == VISUALIZATION
+
+
+def test_closing_fence_split_across_deltas_stops_stream():
+    consumed = []
+
+    def pieces():
+        for piece in [f'x{ANALYSIS_SEPARATOR}```html\n', VISUALIZATION, '\n`', '``', '\n', 'never read']:
+            consumed.append(piece)
+            yield piece
+
+    explanation, visualization = split(pieces())
+    assert explanation == 'x'
+    assert visualization == f'```html\n{VISUALIZATION}'
+    assert 'never read' not in consumed
+
+
+def test_output_without_closing_fence_is_flushed():
+    explanation, visualization = split(deltas(f'x{ANALYSIS_SEPARATOR}```html\n{VISUALIZATION}\n``', 4))
+    assert explanation == 'x'
+    assert visualization == f'```html\n{VISUALIZATION}\n``'
+
+
+def test_output_without_separator_is_all_explanation():
+    explanation, visualization = split(deltas(EXPLANATION, 3))
+    assert explanation == EXPLANATION
+    assert visualization == ''
+
+
+class FakeStream:
+    def __init__(self, text):
+        self.text = text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        for piece in deltas(self.text, 4):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+
+def test_missing_separator_falls_back_to_visualization_call(monkeypatch):
+    calls = []
+    replies = iter([EXPLANATION, f'```html\n{VISUALIZATION}\n```'])
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return FakeStream(next(replies))
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(app, 'get_client', lambda api_key, base_url: client)
+
+    config = {'apiKey': 'key', 'baseUrl': 'http://llm.invalid/v1', 'model': 'model'}
+    response = app.app.test_client().post('/api/analyze', json={
+        'context': 'F = ma (fallback test)',
+        'fullContext': 'F = ma',
+        'reasoningConfig': config,
+        'visionConfig': config
+    })
+    frames = [orjson.loads(frame[len('data: '):]) for frame in response.get_data(as_text=True).split('\n\n') if frame.startswith('data: ')]
+
+    assert len(calls) == 2
+    assert 'stop' not in calls[0]
+    assert calls[1]['stop'] == app.VISUALIZATION_STOP
+    assert frames[-1] == {'type': 'done', 'explanation': EXPLANATION, 'visualization': VISUALIZATION}
@@ -0,0 +1,119 @@
+import pytest
+
+from app import UnsupportedConversion, latex_to_markdown, markdown_to_latex
+
+MARKDOWN_TO_LATEX = [
+    ('# Title', '\\section{Title}'),
+    ('### Deep', '\\subsubsection{Deep}'),
+    ('**bold** and *italic*', '\\textbf{bold} and \\textit{italic}'),
+    ('__bold__ and _italic_', '\\textbf{bold} and \\textit{italic}'),
+    ('Use _italic_ here', 'Use \\textit{italic} here'),
+    ('snake_case_name', 'snake\\_case\\_name'),
+    ('`a_b`', '\\texttt{a\\_b}'),
+    ('`\\cmd{x}`', '\\texttt{\\textbackslash{}cmd\\{x\\}}'),
+    ('costs \\$10', 'costs \\$10'),
+    ('50% & #1', '50\\% \\& \\#1'),
+    ('x^2 outside math', 'x\\textasciicircum{}2 outside math'),
+    ('math $x_1^2$ stays', 'math $x_1^2$ stays'),
+    ('$ x^2 $', '$ x^2 $'),
+    ('$ \\frac{a}{b} $', '$ \\frac{a}{b} $'),
+    ('$$a_b$$', '$$a_b$$'),
+    ('\\begin{align}a_1 &= b\\end{align}', '\\begin{align}a_1 &= b\\end{align}'),
+    ('<font color="red">hot</font>', '\\textcolor{red}{hot}'),
+    ('<font color="#ff0000">hot</font>', '\\textcolor[HTML]{FF0000}{hot}'),
+    ('- a\n- b', '\\begin{itemize}\n    \\item a\n    \\item b\n\\end{itemize}'),
+    ('1. a\n2. b', '\\begin{enumerate}\n    \\item a\n    \\item b\n\\end{enumerate}'),
+    ('- a\n    1. x', '\\begin{itemize}\n    \\item a\n    \\begin{enumerate}\n        \\item x\n    \\end{enumerate}\n\\end{itemize}'),
+]
+
+LATEX_TO_MARKDOWN = [
+    ('\\section{Title}', '# Title'),
+    ('\\subsection{Part}', '## Part'),
+    ('\\textbf{bold} and \\emph{em}', '**bold** and *em*'),
+    ('snake\\_case', 'snake_case'),
+    ('\\texttt{a\\_b}', '`a_b`'),
+    ('50\\% \\& item \\#1', '50% & item #1'),
+    ('\\# not a heading', '\\# not a heading'),
+    ('costs \\$10', 'costs \\$10'),
+    ('Let $ \\textit{F} = m a $ hold', 'Let $ \\textit{F} = m a $ hold'),
+    ('{\\color{red} hot}', '\\textcolor{red}{hot}'),
+    ('\\begin{itemize}\n\\item a\n\\item b\n\\end{itemize}', '- a\n- b'),
+    ('\\textbf{\\textit{x}}', '***x***'),
+    ('\\texttt{\\textbackslash{}n}', '`\\n`'),
+    ('$a \\quad b$ in math', '$a \\quad b$ in math'),
+]
+
+# Markdown in the supported subset survives md -> tex -> md unchanged
+ROUND_TRIPS = [
+    '# Title',
+    '## Section with $x^2$',
+    '**bold** and *italic* text',
+    'snake_case_name',
+    '`a_b`',
+    '50% & #1',
+    'costs \\$10',
+    'x^2 outside math',
+    'inline $a_1 + b$ math',
+    'padded $ x^2 $ math',
+    '- a\n- b',
+    '1. first\n2. second',
+    '- a\n    1. x',
+]
+
+UNSUPPORTED_MARKDOWN = [
+    '```python\nx = 1\n```',
+    '| a | b |',
+    '> quote',
+    '[link](http://example.com)',
+    '---',
+    'costs $10',
+    'costs $10 and $20',
+    '$2x$ starts with a digit',
+    'a lone $ sign',
+]
+
+UNSUPPORTED_LATEX = [
+    '\\documentclass{article}',
+    '\\begin{table}x\\end{table}',
+    'see \\ref{eq1}',
+    '\\begin{itemize}\n\\item a',
+    '\\textbf{unclosed',
+    'costs $10',
+    'line \\\\ break',
+    '\\\\[2mm]',
+    '\\newline',
+    '\\noindent text',
+    '\\vspace{1em}',
+    '\\hfill',
+    'a \\quad b',
+    '% comment\ntext',
+    'Fig.~1',
+    '\\textit{x}\\textbf{y}',
+]
+
+
+@pytest.mark.parametrize('markdown, latex', MARKDOWN_TO_LATEX)
+def test_markdown_to_latex(markdown, latex):
+    assert markdown_to_latex(markdown).strip() == latex
+
+
+@pytest.mark.parametrize('latex, markdown', LATEX_TO_MARKDOWN)
+def test_latex_to_markdown(latex, markdown):
+    assert latex_to_markdown(latex).strip() == markdown
+
+
+@pytest.mark.parametrize('markdown', ROUND_TRIPS)
+def test_round_trip(markdown):
+    assert latex_to_markdown(markdown_to_latex(markdown)).strip() == markdown
+
+
+@pytest.mark.parametrize('markdown', UNSUPPORTED_MARKDOWN)
+def test_unsupported_markdown(markdown):
+    with pytest.raises(UnsupportedConversion):
+        markdown_to_latex(markdown)
+
+
+@pytest.mark.parametrize('latex', UNSUPPORTED_LATEX)
+def test_unsupported_latex(latex):
+    with pytest.raises(UnsupportedConversion):
+        latex_to_markdown(latex)